@@ -33,16 +33,57 @@ class AtomVault:
     def __init__(self, conn):
         self.conn = conn
         self._atoms = {}
+        self._ids = {}    # name -> id, for atoms and their types
+        self._names = {}  # id -> name
 
     def get_id(self, name: str):
-        reply = self.conn.core.InternAtom(True, len(name), name).reply()
-        atom = reply.atom
-        return atom
+        if name not in self._ids:
+            reply = self.conn.core.InternAtom(True, len(name), name).reply()
+            self._remember(name, reply.atom)
+            return reply.atom
+        return self._ids[name]
+
+    def _remember(self, name, id):
+        # zero means the atom does not exist (yet), so ask again next time
+        if id:
+            self._ids[name] = id
+            self._names[id] = name
+
+    def preload(self, names):
+        """ Intern given atoms (and their types) with a single round trip.
+            All names should be in PROPERTYMAP.
+        """
+        names = set(names) - set(self._atoms)
+        for name in names:
+            if name not in PROPERTYMAP:
+                raise Exception("unknown atom/property %s, please add it into PROPERTYMAP" % name)
+        todo = names | {PROPERTYMAP[name][0] for name in names}
+        todo -= set(self._ids)
+        # send all requests first, then wait for replies;
+        # this runs before clients had a chance to create the atoms,
+        # so we create them (we advertise and set them anyway)
+        cookies = [(name, self.conn.core.InternAtom(False, len(name), name))
+                   for name in todo]
+        for name, cookie in cookies:
+            self._remember(name, cookie.reply().atom)
+        for name in names:
+            type = PROPERTYMAP[name]
+            self._atoms[name] = Atom(name, self._ids[name], type,
+                                     self._ids[type[0]])
 
     def get_name(self, id: int):
-        c = self.conn.core.GetAtomName(id)
-        name = c.reply().name.to_string()
-        return name
+        if id not in self._names:
+            c = self.conn.core.GetAtomName(id)
+            self._names[id] = c.reply().name.to_string()
+        return self._names[id]
+
+    def get_names(self, ids):
+        """ Like get_name, but resolves unknown ids with one round trip. """
+        unknown = {id for id in ids if id not in self._names}
+        cookies = [(id, self.conn.core.GetAtomName(id)) for id in unknown]
+        for id, cookie in cookies:
+            self._names[id] = cookie.reply().name.to_string()
+        return [self._names[id] for id in ids]
 
     def __getitem__(self, name):
         if isinstance(name, int):
@@ -19,3 +19,21 @@ def test_get_atom():
 
     # lookup by integer id
     assert atoms[_NET_WM_NAME.id] == _NET_WM_NAME
+
+
+def test_preload():
+    atoms = AtomVault(conn)
+    atoms.preload(["_NET_WM_NAME", "_NET_WM_PID"])
+    assert "_NET_WM_NAME" in atoms._atoms
+    assert "_NET_WM_PID" in atoms._atoms
+    assert atoms._NET_WM_PID.type == ('CARDINAL', 32)
+    assert atoms.WM_NAME.id == xproto.Atom.WM_NAME
+
+
+def test_get_names():
+    atoms = AtomVault(conn)
+    ids = [xproto.Atom.WM_NAME, xproto.Atom.WM_HINTS]
+    assert atoms.get_names(ids) == ["WM_NAME", "WM_HINTS"]
+    # now they are served from cache
+    assert atoms._names[xproto.Atom.WM_HINTS] == "WM_HINTS"
+    assert atoms.get_name(xproto.Atom.WM_NAME) == "WM_NAME"
@@ -0,0 +1,86 @@
+"""
+Squash events that are superseded by later events of the same batch.
+"""
+
+from xcffib.xproto import ConfigWindow
+
+from collections import defaultdict
+
+
+class Coalescer:
+    """ Applies per event type policies to a batch of events.
+
+        A policy is a key function and an optional merge function.
+        Of all events with the same key only the latest one survives
+        (it is dispatched in place of the latest one), merge(old, new)
+        may be used to carry information from the dropped events over.
+        Barriers are event types that must not be reordered with
+        the coalesced events, e.g. ButtonRelease for MotionNotify.
+    """
+
+    def __init__(self):
+        self.policies = {}                  # evname -> (key, merge)
+        self.barriers = defaultdict(set)    # barrier evname -> {evname}
+
+    def add(self, evname, key, merge=None, barriers=()):
+        self.policies[evname] = (key, merge)
+        for barrier in barriers:
+            self.barriers[barrier].add(evname)
+
+    def remove(self, evname):
+        self.policies.pop(evname, None)
+        for evnames in self.barriers.values():
+            evnames.discard(evname)
+
+    def __call__(self, events):
+        """ events is a list of (evname, event), returns a new list. """
+        policies = self.policies
+        barriers = self.barriers
+        result = []
+        dropped = 0
+        index = defaultdict(dict)  # evname -> {key: position in result}
+        for evname, event in events:
+            if evname in barriers:
+                for name in barriers[evname]:
+                    index.pop(name, None)
+            policy = policies.get(evname)
+            if policy is None:
+                result.append((evname, event))
+                continue
+            key, merge = policy
+            positions = index[evname]
+            k = key(event)
+            pos = positions.get(k)
+            if pos is not None:
+                _, prev = result[pos]
+                result[pos] = None
+                dropped += 1
+                if merge:
+                    event = merge(prev, event)
+            positions[k] = len(result)
+            result.append((evname, event))
+        if not dropped:
+            return result
+        return [item for item in result if item is not None]
+
+
+CONFIGURE_FIELDS = [
+    (ConfigWindow.X, "x"),
+    (ConfigWindow.Y, "y"),
+    (ConfigWindow.Width, "width"),
+    (ConfigWindow.Height, "height"),
+    (ConfigWindow.BorderWidth, "border_width"),
+    (ConfigWindow.Sibling, "sibling"),
+    (ConfigWindow.StackMode, "stack_mode"),
+]
+
+
+def merge_configure_requests(old, new):
+    """ Values from the new request win, the rest is taken from the old one. """
+    missing = old.value_mask & ~new.value_mask
+    if missing:
+        for flag, attr in CONFIGURE_FIELDS:
+            if missing & flag:
+                setattr(new, attr, getattr(old, attr))
+        new.value_mask |= missing
+    return new
@@ -0,0 +1,46 @@
+from coalesce import Coalescer, merge_configure_requests
+from xcffib.xproto import ConfigWindow
+from types import SimpleNamespace
+
+
+def configure(wid, value_mask, **values):
+    return ("ConfigureRequest",
+            SimpleNamespace(window=wid, value_mask=value_mask, **values))
+
+
+def test_latest_wins():
+    coalesce = Coalescer()
+    coalesce.add("MotionNotify", key=lambda e: e.event)
+    events = [("MotionNotify", SimpleNamespace(event=1, x=x))
+              for x in range(3)]
+    events.append(("KeyPress", SimpleNamespace(event=1)))
+    result = coalesce(events)
+    assert [(name, getattr(e, "x", None)) for name, e in result] == \
+        [("MotionNotify", 2), ("KeyPress", None)]
+
+
+def test_merge_configure_requests():
+    coalesce = Coalescer()
+    coalesce.add("ConfigureRequest", key=lambda e: e.window,
+                 merge=merge_configure_requests)
+    size = ConfigWindow.Width | ConfigWindow.Height
+    pos = ConfigWindow.X | ConfigWindow.Y
+    result = coalesce([configure(1, size, width=10, height=20),
+                       configure(1, pos, x=1, y=2),
+                       configure(2, pos, x=3, y=4)])
+    assert len(result) == 2
+    event = result[0][1]
+    assert event.value_mask == size | pos
+    assert (event.x, event.y, event.width, event.height) == (1, 2, 10, 20)
+
+
+def test_barrier():
+    coalesce = Coalescer()
+    coalesce.add("ConfigureRequest", key=lambda e: e.window,
+                 merge=merge_configure_requests, barriers=["MapRequest"])
+    events = [configure(1, ConfigWindow.Width, width=10),
+              ("MapRequest", SimpleNamespace(window=1)),
+              configure(1, ConfigWindow.X, x=1)]
+    result = coalesce(events)
+    assert [name for name, _ in result] == \
+        ["ConfigureRequest", "MapRequest", "ConfigureRequest"]
@@ -0,0 +1,192 @@
+"""
+Compact event records passed to hooks instead of raw xcffib events.
+Everything handlers usually need is decoded once, in the event pump:
+window objects, normalized modifiers, hook keys, atom names.
+"""
+
+
+class Event:
+    """ Base class for decoded events. The original event is in .raw """
+    __slots__ = ("raw", "sequence")
+
+    def __init__(self, raw, wm):
+        self.raw = raw
+        self.sequence = raw.sequence
+
+    def __repr__(self):
+        fields = ", ".join("%s=%s" % (name, getattr(self, name))
+                           for cls in reversed(type(self).__mro__[:-1])
+                           for name in cls.__slots__
+                           if not name.startswith("_") and name != "raw")
+        return "%s(%s)" % (self.__class__.__name__, fields)
+
+
+class WindowEvent(Event):
+    """ Map/Unmap/Create/Destroy events. """
+    __slots__ = ("wid", "window", "override_redirect")
+
+    def __init__(self, raw, wm):
+        Event.__init__(self, raw, wm)
+        self.wid = raw.window
+        self.window = wm.windows.get(raw.window)
+        self.override_redirect = getattr(raw, "override_redirect", False)
+
+
+class KeyEvent(Event):
+    __slots__ = ("wid", "window", "detail", "state", "modmask",
+                 "root_x", "root_y", "event_x", "event_y", "time", "key")
+    hook_prefix = "on_key_press"
+
+    def __init__(self, raw, wm):
+        Event.__init__(self, raw, wm)
+        self.wid = raw.event
+        self.window = wm.windows.get(raw.event)
+        self.detail = raw.detail
+        self.state = raw.state
+        # TODO: ignore capslock, scrolllock and other modifiers?
+        self.modmask = raw.state & 0xff  # drop mouse buttons
+        self.root_x = raw.root_x
+        self.root_y = raw.root_y
+        self.event_x = raw.event_x
+        self.event_y = raw.event_y
+        self.time = raw.time
+        # what WM.grab_key() returns
+        self.key = (self.hook_prefix, self.modmask, raw.detail)
+
+
+class KeyReleaseEvent(KeyEvent):
+    __slots__ = ()
+    hook_prefix = "on_key_release"
+
+
+class ButtonEvent(KeyEvent):
+    """ ButtonPress and ButtonRelease. """
+    __slots__ = ("button",)
+    hook_prefix = "on_mouse"
+
+    def __init__(self, raw, wm):
+        self.button = raw.detail
+        KeyEvent.__init__(self, raw, wm)
+
+
+class MotionEvent(ButtonEvent):
+    __slots__ = ()
+
+    def __init__(self, raw, wm):
+        self.button = 1  # TODO: take it from state
+        KeyEvent.__init__(self, raw, wm)
+        # what WM.grab_mouse() returns
+        self.key = (self.hook_prefix, self.modmask, 1)
+
+
+class CrossingEvent(Event):
+    """ EnterNotify and LeaveNotify. """
+    __slots__ = ("wid", "window", "mode", "detail", "state",
+                 "root_x", "root_y")
+
+    def __init__(self, raw, wm):
+        Event.__init__(self, raw, wm)
+        self.wid = raw.event
+        self.window = wm.windows.get(raw.event)
+        self.mode = raw.mode
+        self.detail = raw.detail
+        self.state = raw.state
+        self.root_x = raw.root_x
+        self.root_y = raw.root_y
+
+
+class PropertyEvent(Event):
+    __slots__ = ("wid", "window", "atom", "state", "_name", "_atoms")
+
+    def __init__(self, raw, wm):
+        Event.__init__(self, raw, wm)
+        self.wid = raw.window
+        self.window = wm.windows.get(raw.window)
+        self.atom = raw.atom
+        self.state = raw.state
+        self._name = None
+        self._atoms = wm.atoms
+
+    @property
+    def name(self):
+        """ Atom name, resolved on first access. """
+        if self._name is None:
+            self._name = self._atoms.get_name(self.atom)
+        return self._name
+
+
+class ClientMessageEvent(Event):
+    __slots__ = ("wid", "window", "format", "type", "data",
+                 "_type_name", "_atoms")
+
+    def __init__(self, raw, wm):
+        Event.__init__(self, raw, wm)
+        self.wid = raw.window
+        self.window = wm.windows.get(raw.window)
+        self.format = raw.format
+        self.type = raw.type
+        self.data = raw.data
+        self._type_name = None
+        self._atoms = wm.atoms
+
+    @property
+    def type_name(self):
+        """ Message type (atom name), resolved on first access. """
+        if self._type_name is None:
+            self._type_name = self._atoms.get_name(self.type)
+        return self._type_name
+
+
+class ConfigureRequestEvent(Event):
+    __slots__ = ("wid", "window", "value_mask", "x", "y", "width", "height",
+                 "border_width", "sibling", "stack_mode")
+
+    def __init__(self, raw, wm):
+        Event.__init__(self, raw, wm)
+        self.wid = raw.window
+        self.window = wm.windows.get(raw.window)
+        self.value_mask = raw.value_mask
+        self.x = raw.x
+        self.y = raw.y
+        self.width = raw.width
+        self.height = raw.height
+        self.border_width = raw.border_width
+        self.sibling = raw.sibling
+        self.stack_mode = raw.stack_mode
+
+
+class ConfigureNotifyEvent(Event):
+    __slots__ = ("wid", "window", "x", "y", "width", "height",
+                 "border_width", "override_redirect")
+
+    def __init__(self, raw, wm):
+        Event.__init__(self, raw, wm)
+        self.wid = raw.window
+        self.window = wm.windows.get(raw.window)
+        self.x = raw.x
+        self.y = raw.y
+        self.width = raw.width
+        self.height = raw.height
+        self.border_width = raw.border_width
+        self.override_redirect = raw.override_redirect
+
+
+# evname -> record type, events not listed here are passed as is
+DECODERS = {
+    "KeyPress": KeyEvent,
+    "KeyRelease": KeyReleaseEvent,
+    "ButtonPress": ButtonEvent,
+    "ButtonRelease": ButtonEvent,
+    "MotionNotify": MotionEvent,
+    "EnterNotify": CrossingEvent,
+    "LeaveNotify": CrossingEvent,
+    "PropertyNotify": PropertyEvent,
+    "ClientMessage": ClientMessageEvent,
+    "ConfigureRequest": ConfigureRequestEvent,
+    "ConfigureNotify": ConfigureNotifyEvent,
+    "MapRequest": WindowEvent,
+    "MapNotify": WindowEvent,
+    "UnmapNotify": WindowEvent,
+    "CreateNotify": WindowEvent,
+    "DestroyNotify": WindowEvent,
+}
@@ -0,0 +1,59 @@
+from events import DECODERS, KeyEvent, MotionEvent, PropertyEvent
+from types import SimpleNamespace
+
+
+class FakeAtoms:
+    def __init__(self):
+        self.lookups = 0
+
+    def get_name(self, id):
+        self.lookups += 1
+        return "ATOM_%s" % id
+
+
+wm = SimpleNamespace(windows={42: "window42"}, atoms=FakeAtoms())
+
+
+def input_event(**kwargs):
+    fields = dict(sequence=1, event=42, detail=38, state=0x48 | 0x100,
+                  root_x=10, root_y=20, event_x=1, event_y=2, time=0)
+    fields.update(kwargs)
+    return SimpleNamespace(**fields)
+
+
+def test_key_press():
+    ev = KeyEvent(input_event(), wm)
+    assert ev.window == "window42"
+    assert ev.modmask == 0x48  # button mask is dropped
+    assert ev.key == ("on_key_press", 0x48, 38)
+
+
+def test_mouse():
+    ev = DECODERS["ButtonPress"](input_event(detail=3), wm)
+    assert ev.key == ("on_mouse", 0x48, 3)
+    ev = MotionEvent(input_event(detail=0), wm)
+    assert ev.key == ("on_mouse", 0x48, 1)
+    assert (ev.root_x, ev.root_y) == (10, 20)
+
+
+def test_unknown_window():
+    raw = SimpleNamespace(sequence=1, window=43)
+    ev = DECODERS["UnmapNotify"](raw, wm)
+    assert ev.wid == 43 and ev.window is None
+    assert ev.override_redirect is False
+
+
+def test_property_name_resolved_once():
+    atoms = FakeAtoms()
+    raw = SimpleNamespace(sequence=1, window=42, atom=7, state=0)
+    ev = PropertyEvent(raw, SimpleNamespace(windows={}, atoms=atoms))
+    assert atoms.lookups == 0
+    assert ev.name == "ATOM_7"
+    assert ev.name == "ATOM_7"
+    assert atoms.lookups == 1
+
+
+def test_slots():
+    ev = KeyEvent(input_event(), wm)
+    assert not hasattr(ev, "__dict__")
+    assert "modmask=72" in repr(ev)
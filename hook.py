@@ -1,69 +1,247 @@
+from timers import Timers
+
 from useful.log import Log
 
+from contextlib import contextmanager
 from collections import defaultdict
+from functools import partial
 import traceback
+import asyncio
+
+
+class StopPropagation(Exception):
+    """ Raise it in a handler to skip the rest of handlers for the event. """
+
+
+class Shaper:
+    """ Calls the handler later to limit how often it runs:
+        debounce -- only when there were no calls for this many seconds
+        throttle -- at most once per this many seconds
+        latest   -- at the end of the loop iteration, so a burst of calls
+                    results in one call; a coroutine handler from a previous
+                    call that is still running is cancelled.
+        In all cases the handler gets the arguments of the most recent call.
+    """
+    __slots__ = ("hook", "handler", "debounce", "throttle", "latest",
+                 "args", "pending", "deadline", "next_call", "task")
+
+    def __init__(self, hook, handler, debounce=None, throttle=None,
+                 latest=False):
+        self.hook = hook
+        self.handler = handler
+        self.debounce = debounce
+        self.throttle = throttle
+        self.latest = latest
+        self.args = None  # (event, args, kwargs) of the most recent call
+        self.pending = False  # _fire() is scheduled
+        self.deadline = 0
+        self.next_call = 0
+        self.task = None
+
+    def __call__(self, event, *args, **kwargs):
+        self.args = (event, args, kwargs)
+        if self.pending:
+            if self.debounce:
+                # instead of rescheduling the timer on every call
+                # _fire() checks the deadline and goes to sleep again
+                self.deadline = self.hook.timers.time() + self.debounce
+            return
+        timers = self.hook.timers
+        now = timers.time()
+        if self.debounce:
+            self.deadline = now + self.debounce
+            when = self.deadline
+        elif self.throttle:
+            if now >= self.next_call:
+                self._run(now)
+                return
+            when = self.next_call
+        else:
+            when = now
+        self.pending = True
+        timers.call_at(when, self._fire)
+
+    def _fire(self):
+        timers = self.hook.timers
+        now = timers.time()
+        if self.debounce and self.deadline > now:
+            timers.call_at(self.deadline, self._fire)
+            return
+        self.pending = False
+        if self.args is not None:
+            self._run(now)
+
+    def _run(self, now):
+        event, args, kwargs = self.args
+        self.args = None
+        if self.throttle:
+            self.next_call = now + self.throttle
+        if self.latest and self.task and not self.task.done():
+            self.task.cancel()
+        result = self.hook._call(self.handler, event, args, kwargs)
+        if isinstance(result, asyncio.Future):  # coroutine handler
+            self.task = result
+
+    def cancel(self):
+        self.args = None
 
 
 class Hook:
-    """ Simple callback dispatcher. """
+    """ Simple callback dispatcher.
+        Handlers with higher priority are called first,
+        handlers with the same priority in order of registration.
+        Coroutine functions (async def) are run as tasks on the loop,
+        so they do not block event processing.
+        Handlers registered with debounce, throttle or latest (see Shaper)
+        are called later and cannot stop propagation.
+    """
+    trace = False  # log every fire() call, this is slow
+    task_timeout = 60  # seconds, None to wait forever
 
-    def __init__(self):
-        self.cb_map = defaultdict(list)
+    def __init__(self, loop=None, timers=None):
+        self.cb_map = {}  # event -> tuple of handlers in call order
+        # event -> [(priority, cb, handler)], handler is what fire() calls
+        self._entries = defaultdict(list)
         self.log = Log("hook")
-        self.suppressed = set()
+        self.suppressed = {}  # event -> nesting depth
+        self.watchers = []
+        self.loop = loop
+        self._timers = timers
+        self.tasks = {}  # running task -> (event, handler)
 
-    def decor(self, event):
+    @property
+    def timers(self):
+        if self._timers is None:
+            self._timers = Timers(self.loop or asyncio.get_event_loop())
+        return self._timers
+
+    @timers.setter
+    def timers(self, timers):
+        self._timers = timers
+
+    def decor(self, event, priority=0, **shaping):
         def wrap(cb):
-            self.register(event, cb)
+            self.register(event, cb, priority, **shaping)
             return cb
         return wrap
     __call__ = decor
 
-    def register(self, event, cb):
-        self.cb_map[event].append(cb)
+    def register(self, event, cb, priority=0,
+                 debounce=None, throttle=None, latest=False):
+        """ See Shaper for debounce, throttle and latest. """
+        handler = cb
+        if asyncio.iscoroutinefunction(cb):
+            handler = partial(self._spawn, cb)
+        if debounce or throttle or latest:
+            handler = Shaper(self, handler, debounce, throttle, latest)
+        self._entries[event].append((priority, cb, handler))
+        self._rebuild(event)
 
-    def has_hook(self, event):
-        return event in self.cb_map
+    def unregister(self, event, cb):
+        entries = self._entries.get(event, [])
+        for entry in entries:
+            if entry[1] == cb:
+                entries.remove(entry)
+                if isinstance(entry[2], Shaper):
+                    entry[2].cancel()
+                break
+        else:
+            self.log.notice("{} is not registered for {}".format(cb, event))
+            return
+        if not entries:
+            del self._entries[event]
+        self._rebuild(event)
 
-    def suppress(self, event):
-        hook = self
+    def _rebuild(self, event):
+        # registration is rare, so all sorting is done here and not in fire()
+        entries = self._entries.get(event)
+        if entries:
+            # sort is stable, so registration order is kept
+            entries.sort(key=lambda entry: -entry[0])
+            self.cb_map[event] = tuple(handler for _, _, handler in entries)
+        else:
+            self.cb_map.pop(event, None)
+        self._changed(event)
+
+    def _spawn(self, cb, event, *args, **kwargs):
+        coro = cb(event, *args, **kwargs)
+        if self.task_timeout is not None:
+            coro = asyncio.wait_for(coro, self.task_timeout)
+        loop = self.loop or asyncio.get_event_loop()
+        task = loop.create_task(coro)
+        self.tasks[task] = (event, cb)
+        task.add_done_callback(self._task_done)
+        return task
 
-        class Context:
+    def _task_done(self, task):
+        event, cb = self.tasks.pop(task)
+        if task.cancelled():
+            return
+        err = task.exception()
+        if err is None or isinstance(err, StopPropagation):
+            return  # too late to stop anything, handlers already ran
+        if isinstance(err, asyncio.TimeoutError):
+            self.log.error("{} for {} timed out after {}s".format(
+                cb, event, self.task_timeout))
+            return
+        self.log.error("".join(traceback.format_exception(
+            type(err), err, err.__traceback__)))
 
-            def __enter__(self):
-                hook.log.debug("suppressing %s" % event)
-                hook.suppressed.add(event)
+    def cancel_tasks(self, event=None):
+        """ Cancel running coroutine handlers (for the given event only). """
+        for task, (ev, _) in list(self.tasks.items()):
+            if event is None or ev == event:
+                task.cancel()
 
-            def __exit__(self, *args):
-                hook.log.debug("un-suppressing %s" % event)
-                if event in hook.suppressed:
-                    hook.suppressed.remove(event)
-                else:
-                    hook.log.notice("uhm, event is not suppressed: %s" % event)
-        return Context()
+    def watch(self, cb):
+        """ cb(event) is called when handlers for event are added or removed. """
+        self.watchers.append(cb)
 
-    def fire(self, event, *args, **kwargs):
-        self.log.debug("{} {} {}".format(event, args, kwargs))
-        if event not in self.cb_map:
-            self.log.notice("no handler for {}".format(event))
-            return
+    def _changed(self, event):
+        for cb in self.watchers:
+            cb(event)
 
-        if event in self.suppressed:
-            self.log.debug(
-                "event suppressed: {} {} {}".format(event, args, kwargs))
+    def has_hook(self, event):
+        return event in self.cb_map
+
+    @contextmanager
+    def suppress(self, event):
+        """ Handlers are not called inside this block. Can be nested. """
+        suppressed = self.suppressed
+        suppressed[event] = suppressed.get(event, 0) + 1
+        try:
+            yield
+        finally:
+            depth = suppressed[event] - 1
+            if depth:
+                suppressed[event] = depth
+            else:
+                del suppressed[event]
+
+    def fire(self, event, *args, **kwargs):
+        handlers = self.cb_map.get(event)
+        if self.trace:
+            self.log.debug("{} {} {}".format(event, args, kwargs))
+            if not handlers:
+                self.log.notice("no handler for {}".format(event))
+            elif event in self.suppressed:
+                self.log.debug("event suppressed: {}".format(event))
+        if not handlers or event in self.suppressed:
             return
 
-        handlers = self.cb_map[event]
         for handler in handlers:
             try:
                 handler(event, *args, **kwargs)
-            # except SupressEvent:
-                # break
-            except Exception as err:
-                # msg = "error on event {ev}: {err} ({typ}) (in {hdl})" \
-                #     .format(err=err, typ=type(err), ev=event, hdl=handler)
-                msg = traceback.format_exc()
-                self.log.error(msg)
-
-        # if DEBUG:
-        #    time.sleep(0.03)
+            except StopPropagation:
+                break
+            except Exception:
+                self.log.error(traceback.format_exc())
+
+    def _call(self, handler, event, args, kwargs):
+        """ Call a handler outside of fire(), e.g. from a timer. """
+        try:
+            return handler(event, *args, **kwargs)
+        except StopPropagation:
+            pass  # nothing to stop here
+        except Exception:
+            self.log.error(traceback.format_exc())
@@ -0,0 +1,154 @@
+from hook import Hook, StopPropagation
+from timers import Timers
+import asyncio
+
+
+def test_priorities():
+    hook = Hook()
+    calls = []
+    hook.register("ev", lambda ev: calls.append("a"))
+    hook.register("ev", lambda ev: calls.append("b"), priority=10)
+    hook.register("ev", lambda ev: calls.append("c"))
+    hook.fire("ev")
+    assert calls == ["b", "a", "c"]
+
+
+def test_stop_propagation():
+    hook = Hook()
+    calls = []
+
+    @hook("ev", priority=1)
+    def first(ev):
+        calls.append(1)
+        raise StopPropagation
+
+    hook.register("ev", lambda ev: calls.append(2))
+    hook.fire("ev")
+    assert calls == [1]
+    hook.unregister("ev", first)
+    hook.fire("ev")
+    assert calls == [1, 2]
+
+
+def test_nested_suppress():
+    hook = Hook()
+    calls = []
+    hook.register("ev", lambda ev, x: calls.append(x))
+    with hook.suppress("ev"):
+        with hook.suppress("ev"):
+            hook.fire("ev", 1)
+        hook.fire("ev", 2)
+    hook.fire("ev", 3)
+    assert calls == [3]
+    assert not hook.suppressed
+
+
+def test_watch():
+    hook = Hook()
+    changes = []
+    hook.watch(changes.append)
+    cb = hook.decor("ev")(lambda ev: None)
+    hook.unregister("ev", cb)
+    assert changes == ["ev", "ev"]
+    assert not hook.has_hook("ev")
+
+
+def test_async_handlers():
+    loop = asyncio.new_event_loop()
+    hook = Hook(loop)
+    hook.task_timeout = 0.01
+    calls = []
+
+    @hook("ev")
+    async def slow(ev, x):
+        calls.append(x)
+        await asyncio.sleep(1)
+        calls.append("never")
+
+    hook.register("ev", lambda ev, x: calls.append("sync"))
+    hook.fire("ev", 1)
+    assert calls == ["sync"]  # async handler is only scheduled
+    assert len(hook.tasks) == 1
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert calls == ["sync", 1]
+    assert not hook.tasks  # timed out
+    loop.close()
+
+
+class FakeLoop:
+    """ Just enough of an event loop for Timers, with a manual clock. """
+
+    class Handle:
+        def __init__(self, when, cb):
+            self.when = when
+            self.cb = cb
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self):
+        self.now = 0.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, cb):
+        handle = self.Handle(when, cb)
+        self.handles.append(handle)
+        return handle
+
+    def advance(self, seconds):
+        end = self.now + seconds
+        while True:
+            due = [h for h in self.handles
+                   if not h.cancelled and h.when <= end]
+            if not due:
+                break
+            handle = min(due, key=lambda h: h.when)
+            self.handles.remove(handle)
+            self.now = max(self.now, handle.when)
+            handle.cb()
+        self.now = end
+
+
+def shaped_hook():
+    loop = FakeLoop()
+    return loop, Hook(loop, Timers(loop))
+
+
+def test_debounce():
+    loop, hook = shaped_hook()
+    calls = []
+    hook.register("ev", lambda ev, x: calls.append(x), debounce=0.02)
+    for x in range(5):
+        hook.fire("ev", x)
+        loop.advance(0.005)
+    assert calls == []
+    loop.advance(0.015)
+    assert calls == [4]  # only once the burst is over
+    assert len(loop.handles) == 0  # no timer left behind
+
+
+def test_throttle():
+    loop, hook = shaped_hook()
+    calls = []
+    hook.register("ev", lambda ev, x: calls.append(x), throttle=0.02)
+    for x in range(5):
+        hook.fire("ev", x)
+        loop.advance(0.005)
+    assert calls == [0, 3]  # leading call, then one per interval
+    loop.advance(0.02)
+    assert calls == [0, 3, 4]  # trailing call with the latest arguments
+
+
+def test_latest_wins():
+    loop, hook = shaped_hook()
+    calls = []
+    hook.register("ev", lambda ev, x: calls.append(x), latest=True)
+    for x in range(3):
+        hook.fire("ev", x)
+    assert calls == []
+    loop.advance(0)
+    assert calls == [2]
@@ -152,7 +152,6 @@ def on_window_create(event, window: Window):
         # log.critical("PANEL!")
     if window.type in ["dropdown", "menu", "notification", "tooltip"]:
         window.can_focus = False
-prev_handler = None
 
 
 @wm.hook("new_window")
@@ -172,17 +171,12 @@ def on_window_unmap(event, window):
 
 @wm.hook("unknown_window")
 def unknown_window(event, wid):
-    run_("xprop -id %s" % wid)
-    wm.on_new_window(wid)
+    wm.reconcile()
 
 
-@wm.hook("window_enter")
+@wm.hook("window_enter", debounce=0.15)
 def on_window_enter(event, window):
-    global prev_handler
-
-    if prev_handler:
-        prev_handler.cancel()
-
+    # called once the pointer rests on a window for a while
     if window == wm.root:
         return
 
@@ -190,13 +184,9 @@ def on_window_enter(event, window):
         log.notice("we do not focus on the same window {}".format(window))
         return
 
-    log._switch.debug("delaying activation of %s" % window)
-
-    def _switch(window=window):
-        log._switch.debug("okay, it's time to switch to %s" % window)
-        wm.focus_on(window)
-        window.rise()
-    prev_handler = loop.call_later(0.15, _switch)
+    log._switch.debug("okay, it's time to switch to %s" % window)
+    wm.focus_on(window)
+    window.rise()
 
 
 # TODO: get rid of this function in favor of wm.focus_on()
@@ -3,34 +3,81 @@ from atom import Atom
 
 from xcffib import xproto
 
+
+def request_property(conn, wid, prop, typ):
+    """ Send GetProperty for the whole value without waiting for reply. """
+    return conn.core.GetProperty(
+        False,           # delete
+        wid,             # window id
+        prop,
+        typ,
+        0,               # long_offset,
+        (2 ** 32) - 1    # long_length
+    )
+
+
 class Props:
+    """ Window properties. Values are cached until X server tells us
+        they are changed, see invalidate().
+    """
 
     def __init__(self, window, conn, atoms):
         self.window = window
         self.atoms = atoms
         self.conn = conn
+        self._pending = {}  # atom id -> cookie sent in advance
+        self._cache = {}    # atom id -> decoded value
+
+    def request(self, prop):
+        """ Send request for the property, the reply is picked up later
+            by __getitem__. Use it to avoid sequential round trips.
+        """
+        if isinstance(prop, str):
+            prop = self.atoms[prop]
+        if prop.id not in self._pending and prop.id not in self._cache:
+            self._pending[prop.id] = request_property(
+                self.conn, self.window.wid, prop.id, prop.rawtype)
+
+    def discard(self):
+        """ Forget about requests we are not interested in anymore. """
+        for cookie in self._pending.values():
+            cookie.discard_reply()
+        self._pending.clear()
+
+    def invalidate(self, atom_id):
+        """ Property changed on the server (PropertyNotify). """
+        self._cache.pop(atom_id, None)
+        cookie = self._pending.pop(atom_id, None)
+        if cookie:
+            cookie.discard_reply()
 
     def __getitem__(self, prop):
         if isinstance(prop, str):
             prop = self.atoms[prop]
 
-        typ, typ_fmt = prop.type
-        wid = self.window.wid
-        r = self.conn.core.GetProperty(
-            False,           # delete
-            wid,             # window id
-            prop.id,
-            prop.rawtype,
-            0,               # long_offset,
-            (2 ** 32) - 1    # long_length
-        ).reply()
+        try:
+            return self._cache[prop.id]
+        except KeyError:
+            pass
+        cookie = self._pending.pop(prop.id, None)
+        if cookie is None:
+            cookie = request_property(
+                self.conn, self.window.wid, prop.id, prop.rawtype)
+        value = self.decode(prop, cookie.reply())
+        if self.window.wm.cache_props:
+            self._cache[prop.id] = value
+        return value
 
+    def decode(self, prop, r):
+        """ Convert GetPropertyReply into a python value. """
+        typ, typ_fmt = prop.type
         if typ == CARDINAL:
             return r.value.to_atoms()[0]
         elif typ in ["STRING", "UTF8_STRING"]:
             return r.value.to_utf8()
         elif typ == ATOM:
-            return [self.atoms[id] for id in r.value.to_atoms()]
+            names = self.atoms.get_names(r.value.to_atoms())
+            return [getattr(self.atoms, name) for name in names]
         else:
             raise Exception("Uknown type {}".format(typ))
 
@@ -40,6 +87,7 @@ class Props:
 
         _, type_fmt = prop.type
         wid = self.window.wid
+        self.invalidate(prop.id)
 
         # pack data into a format readable by xcffib
         if isinstance(value, str):
@@ -64,7 +112,7 @@ class Props:
         else:
             raise Exception("unknown type %s" % type(value))
 
-        self.conn.core.ChangePropertyChecked(
+        cookie = self.conn.core.ChangeProperty(
             xproto.PropMode.Replace,
             wid,
             prop.id,
@@ -72,7 +120,10 @@ class Props:
             type_fmt,  # Format - 8, 16, 32
             len(value),
             value
-        ).check()
+        )
+        wm = self.window.wm
+        wm.track(cookie, self.window, "props[%s]" % prop.name)
+        wm.flush()
 
     def __dir__(self):
         wid = self.window.wid
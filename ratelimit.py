@@ -0,0 +1,120 @@
+"""
+Protection against clients flooding us with events.
+"""
+
+
+class TokenBucket:
+    """ Allows `rate` events per second with bursts up to `burst` events. """
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now):
+        """ Returns True if there was a token for one more event. """
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return True
+        self.tokens = tokens
+        return False
+
+    def wait_time(self):
+        """ Seconds till the next token. """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """ Per window token buckets for the given event types.
+        Events over budget are parked and released later (see release()).
+        coalesce(events) is used to keep the parked lists short.
+    """
+
+    def __init__(self, rate=50, burst=100, coalesce=None):
+        self.rate = rate
+        self.burst = burst
+        self.coalesce = coalesce
+        # evname -> function to get window id from the event
+        self.limited = {
+            "ConfigureRequest": lambda e: e.window,
+            "PropertyNotify": lambda e: e.window,
+        }
+        # events that must not overtake parked events of their window
+        self.barriers = {
+            "MapRequest": lambda e: e.window,
+            "MapNotify": lambda e: e.window,
+            "UnmapNotify": lambda e: e.window,
+        }
+        self.buckets = {}  # wid -> TokenBucket
+        self.parked = {}   # wid -> [(evname, event)]
+        self.storms = set()  # wids that are over budget right now
+
+    def filter(self, events, now):
+        """ Returns (events to dispatch, [(wid, evname)] of new storms). """
+        limited = self.limited
+        barriers = self.barriers
+        parked = self.parked
+        result = []
+        storms = []
+        for item in events:
+            get_wid = limited.get(item[0])
+            if get_wid is None:
+                get_wid = barriers.get(item[0])
+                if get_wid and parked:
+                    wid = get_wid(item[1])
+                    if wid in parked:
+                        # e.g. configure has to be applied before the map
+                        result.extend(self._unpark(wid))
+                result.append(item)
+                continue
+            wid = get_wid(item[1])
+            if wid in parked:
+                # keep order with events that are already parked
+                queue = parked[wid]
+                queue.append(item)
+                if self.coalesce and len(queue) > self.burst:
+                    parked[wid] = self.coalesce(queue)
+                continue
+            bucket = self.buckets.get(wid)
+            if bucket is None:
+                bucket = self.buckets[wid] = \
+                    TokenBucket(self.rate, self.burst, now)
+            if bucket.take(now):
+                result.append(item)
+                # a storm is over when the bucket is full again
+                if wid in self.storms and bucket.tokens >= bucket.burst - 1:
+                    self.storms.discard(wid)
+                continue
+            parked[wid] = [item]
+            if wid not in self.storms:
+                self.storms.add(wid)
+                storms.append((wid, item[0]))
+        return result, storms
+
+    def next_release(self):
+        """ Seconds till some of the parked events can be released. """
+        return min(self.buckets[wid].wait_time() for wid in self.parked)
+
+    def release(self, now):
+        """ Returns parked events of windows that have tokens again. """
+        result = []
+        for wid in list(self.parked):
+            if self.buckets[wid].take(now):
+                result.extend(self._unpark(wid))
+        return result
+
+    def _unpark(self, wid):
+        events = self.parked.pop(wid)
+        if self.coalesce and len(events) > 1:
+            events = self.coalesce(events)
+        return events
+
+    def forget(self, wid):
+        """ Window is gone, drop everything we know about it. """
+        self.buckets.pop(wid, None)
+        self.parked.pop(wid, None)
+        self.storms.discard(wid)
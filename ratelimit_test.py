@@ -0,0 +1,58 @@
+from ratelimit import RateLimiter, TokenBucket
+from types import SimpleNamespace
+
+
+def configure(wid):
+    return ("ConfigureRequest", SimpleNamespace(window=wid))
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2, now=0)
+    assert bucket.take(0)
+    assert bucket.take(0)
+    assert not bucket.take(0)
+    assert bucket.wait_time() > 0
+    assert bucket.take(0.1)
+
+
+def test_storm_is_parked():
+    limiter = RateLimiter(rate=10, burst=3)
+    quiet = configure(2)
+    events = [configure(1) for _ in range(5)] + [quiet]
+    result, storms = limiter.filter(events, now=0)
+    assert result == events[:3] + [quiet]
+    assert storms == [(1, "ConfigureRequest")]
+    assert len(limiter.parked[1]) == 2
+    # reported only once
+    _, storms = limiter.filter([configure(1)], now=0)
+    assert storms == []
+    assert limiter.release(now=0) == []
+    assert len(limiter.release(now=limiter.next_release())) == 3
+    assert not limiter.parked
+
+
+def test_other_events_pass():
+    limiter = RateLimiter(rate=1, burst=1)
+    events = [("KeyPress", SimpleNamespace(window=1))] * 10
+    result, storms = limiter.filter(events, now=0)
+    assert result == events and not storms
+
+
+def test_parked_events_are_coalesced():
+    limiter = RateLimiter(rate=1, burst=1, coalesce=lambda evs: evs[-1:])
+    limiter.filter([configure(1) for _ in range(10)], now=0)
+    assert len(limiter.parked[1]) <= 2
+    assert len(limiter.release(now=1)) == 1
+    limiter.forget(1)
+    assert not limiter.buckets and not limiter.storms
+
+
+def test_barrier_releases_parked_events():
+    limiter = RateLimiter(rate=1, burst=1)
+    limiter.filter([configure(1)], now=0)
+    parked = configure(1)
+    limiter.filter([parked], now=0)
+    map_request = ("MapRequest", SimpleNamespace(window=1))
+    result, _ = limiter.filter([map_request], now=0)
+    assert result == [parked, map_request]
+    assert not limiter.parked
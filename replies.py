@@ -0,0 +1,71 @@
+"""
+Awaitable replies on top of xcffib cookies.
+"""
+
+from xreader import c_free
+
+from xcffib import ffi, lib, CffiUnpacker
+
+from collections import deque
+
+
+class ReplyQueue:
+    """ Resolves futures for requests as soon as their replies arrive.
+        Nothing here blocks: the queue is polled when the connection
+        becomes readable and after each flush.
+    """
+
+    def __init__(self, conn, loop):
+        self._conn = conn
+        self._loop = loop
+        self._pending = deque()  # (cookie, future) in request order
+        self._reply_p = ffi.new("void **")
+        self._error_p = ffi.new("xcb_generic_error_t **")
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, cookie):
+        """ Returns a future that will be resolved with the reply. """
+        future = self._loop.create_future()
+        self._pending.append((cookie, future))
+        return future
+
+    def poll(self):
+        """ Resolve futures for replies that are already received. """
+        pending = self._pending
+        reply_p = self._reply_p
+        error_p = self._error_p
+        while pending:
+            cookie, future = pending[0]
+            reply_p[0] = ffi.NULL
+            error_p[0] = ffi.NULL
+            # replies come in request order, so we stop on the first one
+            # that is still in flight
+            if not lib.xcb_poll_for_reply(self._conn._conn, cookie.sequence,
+                                          reply_p, error_p):
+                break
+            pending.popleft()
+            if error_p[0] != ffi.NULL:
+                error = self._unpack_error(ffi.gc(error_p[0], c_free))
+                if not future.done():
+                    future.set_exception(error)
+            elif reply_p[0] != ffi.NULL:
+                data = ffi.gc(reply_p[0], c_free)
+                length = ffi.cast("xcb_generic_reply_t *", data).length
+                reply = cookie.reply_type(
+                    CffiUnpacker(data, known_max=32 + length * 4))
+                if not future.done():
+                    future.set_result(reply)
+            elif not future.done():
+                future.set_result(None)
+
+    def cancel(self):
+        """ Cancel all outstanding futures. """
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+
+    def _unpack_error(self, c_error):
+        error = self._conn._error_offsets[c_error.error_code]
+        return error(CffiUnpacker(c_error))
@@ -0,0 +1,74 @@
+"""
+Cheap timers for things that are (re)scheduled all the time.
+"""
+
+from useful.log import Log
+
+from itertools import count
+import heapq
+import traceback
+
+
+class Timers:
+    """ Many timers on top of a single loop.call_at() handle.
+        There are no handles to cancel, callbacks are supposed to check
+        themselves if they are still needed (see hook.Shaper).
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.log = Log("timers")
+        self._heap = []  # (when, seq, cb)
+        self._seq = count()  # keeps callbacks with the same time in order
+        self._handle = None
+        self._when = None  # when _handle fires
+        self._now = None  # time() while callbacks are run
+
+    def __len__(self):
+        return len(self._heap)
+
+    def time(self):
+        """ Callbacks run at once see the same time, the one _run() used
+            to pick them, so they never consider themselves early.
+        """
+        if self._now is not None:
+            return self._now
+        return self.loop.time()
+
+    def call_at(self, when, cb):
+        heapq.heappush(self._heap, (when, next(self._seq), cb))
+        if self._when is None or when < self._when:
+            self._schedule(when)
+
+    def call_later(self, delay, cb):
+        self.call_at(self.loop.time() + delay, cb)
+
+    def clear(self):
+        self._heap.clear()
+        if self._handle:
+            self._handle.cancel()
+        self._handle = self._when = None
+
+    def _schedule(self, when):
+        if self._handle:
+            self._handle.cancel()
+        self._when = when
+        self._handle = self.loop.call_at(when, self._run)
+
+    def _run(self):
+        self._handle = self._when = None
+        heap = self._heap
+        # asyncio may run us a bit early, see BaseEventLoop._run_once()
+        now = self._now = self.loop.time() + 0.001
+        try:
+            while heap and heap[0][0] <= now:
+                _, _, cb = heapq.heappop(heap)
+                try:
+                    cb()
+                except Exception:
+                    self.log.error(traceback.format_exc())
+        finally:
+            self._now = None
+        # callbacks might have scheduled something already
+        if heap and (self._when is None or heap[0][0] < self._when):
+            self._schedule(heap[0][0])
@@ -1,7 +1,7 @@
 from defs import PROPERTYMAP, WINDOW_TYPES, HintsFlags
-from props import Props
+from props import Props, request_property
 
-from xcffib.xproto import CW, EventMask, Atom
+from xcffib.xproto import CW, Atom
 from xcffib import xproto
 
 from useful.log import Log
@@ -53,8 +53,16 @@ class Window:
     skip = False  # do not handle show() and hide() for this event
     type = "normal"
     name = "<no name>"
-
-    def __init__(self, wm, wid, atoms, mapped=True):
+    ready = False  # setup() is done
+    # properties requested by request_initial() for setup()
+    initial_props = ["_NET_WM_VISIBLE_NAME", "_NET_WM_NAME",
+                     "_NET_WM_WINDOW_TYPE"]
+
+    def __init__(self, wm, wid, atoms, mapped=True, setup=True):
+        """ With setup=False only the requests are sent, call setup() later
+            to collect the replies. This allows to create many windows
+            without waiting for a round trip for each of them.
+        """
         from wm import WM  # TODO: dirtyhack to avoid circular imports
         assert isinstance(wm, WM), "wm must be an instance of WM"
         assert isinstance(wid, int), "wid must be int"
@@ -62,29 +70,84 @@ class Window:
         self.wm = wm
         self._conn = self.wm._conn
         self.prev_geometry = None
+        self._geometry = None  # see get_geometry()
+        # sequence of the last ConfigureWindow sent by set_geometry(),
+        # ConfigureNotify events from before it carry outdated geometry
+        self.configure_sequence = None
         self.props = Props(conn=self._conn, window=self, atoms=atoms)
+        self.mapped = mapped
+        # sequence of the last UnmapWindow sent by hide(), the UnmapNotify
+        # it causes carries the same (16 bit) sequence number
+        self.unmap_sequence = None
+        self.hints = {}
+        self._cookies = {}
+        self.request_initial()
+        if setup:
+            self.setup()
+
+    def request_initial(self):
+        """ Send all requests needed by setup() in one go. """
+        # subscribe for notifications before asking for properties,
+        # so that we do not miss changes in between
+        cookie = self._conn.core.ChangeWindowAttributes(
+            self.wid, CW.EventMask, [self.wm.window_mask])
+        self.wm.track(cookie, self, "request_initial")
+        self._cookies["geometry"] = self._conn.core.GetGeometry(self.wid)
+        self._cookies["hints"] = request_property(
+            self._conn, self.wid, Atom.WM_HINTS, xproto.GetPropertyType.Any)
+        for prop in self.initial_props:
+            self.props.request(prop)
+
+    def refresh_initial(self, atom_id):
+        """ Property changed before setup(), re-request it
+            if setup() is going to need it.
+        """
+        self.props.invalidate(atom_id)
+        if atom_id == Atom.WM_HINTS:
+            cookie = self._cookies.pop("hints", None)
+            if cookie:
+                cookie.discard_reply()
+            self._cookies["hints"] = request_property(
+                self._conn, self.wid, Atom.WM_HINTS,
+                xproto.GetPropertyType.Any)
+            return
+        for prop in self.initial_props:
+            prop = self.props.atoms[prop]
+            if prop.id == atom_id:
+                self.props.request(prop)
+                return
+
+    def setup(self):
+        """ Collect replies for request_initial(). """
         self.update_name()  # TODO: this is not updated
         self.update_window_type()
         # do it after self.name is set (so repr works)
         self.log = Log(self)
-        self.mapped = mapped
-        self.hints = {}
         self.update_wm_hints()
-        # subscribe for notifications
-        self._conn.core.ChangeWindowAttributesChecked(
-            wid, CW.EventMask, [EventMask.EnterWindow])
+        self.ready = True
+        return self
+
+    def discard(self):
+        """ Drop replies to requests sent by request_initial().
+            Use it if setup() is not going to be called.
+        """
+        for cookie in self._cookies.values():
+            cookie.discard_reply()
+        self._cookies.clear()
+        self.props.discard()
 
     def show(self):
         assert not self.skip
         self.log.show.debug("showing")
         self._conn.core.MapWindow(self.wid)
-        self.wm.flush()
+        self.wm.expect_crossing()
         self.mapped = True
 
     def hide(self):
         assert not self.skip
-        self._conn.core.UnmapWindow(self.wid)
-        self.wm.flush()
+        cookie = self._conn.core.UnmapWindow(self.wid)
+        self.unmap_sequence = cookie.sequence & 0xffff
+        self.wm.expect_crossing()
         self.mapped = False
 
     def rise(self):
@@ -100,10 +163,11 @@ class Window:
         return self.stackmode(xproto.StackMode.Opposite)
 
     def stackmode(self, mode):
-        self._conn.core.ConfigureWindowChecked(self.wid,
-                                               xproto.ConfigWindow.StackMode,
-                                               [mode]).check()
-        self.wm.flush()
+        cookie = self._conn.core.ConfigureWindow(self.wid,
+                                                 xproto.ConfigWindow.StackMode,
+                                                 [mode])
+        self.wm.track(cookie, self, "stackmode")
+        self.wm.expect_crossing()
 
     def focus(self):
         """ Let window receive mouse and keyboard events.
@@ -115,7 +179,7 @@ class Window:
         # TODO: self.wm.root.set_property("_NET_ACTIVE_WINDOW", self.wid)
         self._conn.core.SetInputFocus(xproto.InputFocus.PointerRoot,
                                       self.wid, xproto.Time.CurrentTime)
-        self.wm.flush()  # it is here mandatory :(
+        self.wm.flush()
         return self
 
     def kill(self):
@@ -167,8 +231,37 @@ class Window:
 
     @property
     def geometry(self):
-        geom = self._conn.core.GetGeometry(self.wid).reply()
-        return [geom.x, geom.y, geom.width, geom.height]
+        return self.get_geometry()
+
+    def get_geometry(self, force=False):
+        """ Returns [x, y, width, height]. The value is cached and kept
+            up to date by ConfigureNotify and set_geometry(),
+            use force=True to ask X server anyway.
+        """
+        if force or self._geometry is None:
+            cookie = self._cookies.pop("geometry", None)
+            if cookie and force:
+                cookie.discard_reply()
+                cookie = None
+            if cookie is None:
+                cookie = self._conn.core.GetGeometry(self.wid)
+            geom = cookie.reply()
+            self._geometry = [geom.x, geom.y, geom.width, geom.height]
+        return list(self._geometry)
+
+    def update_geometry(self, x=None, y=None, width=None, height=None):
+        """ Update cached geometry without talking to X server. """
+        cookie = self._cookies.pop("geometry", None)
+        if cookie:
+            cookie.discard_reply()
+        if self._geometry is None:
+            if None in (x, y, width, height):
+                return  # will be fetched on first access
+            self._geometry = [x, y, width, height]
+            return
+        for i, value in enumerate((x, y, width, height)):
+            if value is not None:
+                self._geometry[i] = value
 
     def set_geometry(self, x=None, y=None, width=None, height=None):
         mask = 0
@@ -185,11 +278,17 @@ class Window:
         if height is not None:
             mask |= xproto.ConfigWindow.Height
             values.append(height)
-        # TODO: what the hell is *Checked and check?
 
         # filter negative values
         values = [max(value, 0) for value in values]
-        self._conn.core.ConfigureWindowChecked(self.wid, mask, values).check()
+        # errors are reported asynchronously, see WM.on_x_error
+        cookie = self._conn.core.ConfigureWindow(self.wid, mask, values)
+        self.wm.track(cookie, self, "set_geometry")
+        self.configure_sequence = cookie.sequence & 0xffff
+        self.wm._configuring.add(self)
+        self.wm.expect_crossing()
+        self.update_geometry(*(None if v is None else max(v, 0)
+                               for v in (x, y, width, height)))
 
     def update_name(self):
         name = "(no name)"
@@ -210,7 +309,7 @@ class Window:
             0, 0,                           # src_width, src_height
             width // 2, height // 2         # dest_x, dest_y
         )
-        self.wm.flush()
+        self.wm.expect_crossing()
         return self
 
     def get_attributes(self):
@@ -219,9 +318,11 @@ class Window:
 
     def set_attr(self, **kwargs):
         mask, values = AttributeMasks(**kwargs)
-        self.wm._conn.core.ChangeWindowAttributesChecked(
+        cookie = self.wm._conn.core.ChangeWindowAttributes(
             self.wid, mask, values
         )
+        self.wm.track(cookie, self, "set_attr")
+        self.wm.flush()
 
     def get_prop(self, prop, typ=None, unpack=None):
         """
@@ -240,15 +341,12 @@ class Window:
         prop = self.wm.atoms[prop] if isinstance(prop, str) else prop
         typ = self.wm.atoms[typ] if isinstance(typ, str) else typ
 
-        r = self._conn.core.GetProperty(
-            False,         # delete
-            self.wid,      # window id
-            prop,
-            typ,
-            0,             # long_offset,
-            (2 ** 32) - 1  # long_length
-        ).reply()
+        r = request_property(self._conn, self.wid, prop, typ).reply()
+        return self.unpack_prop(r, unpack)
 
+    @staticmethod
+    def unpack_prop(r, unpack=None):
+        """ See get_prop. """
         if not r.value_len:
             if unpack:
                 return []
@@ -287,7 +385,7 @@ class Window:
         elif isinstance(value, int):
             value = [value]
 
-        self.wm._conn.core.ChangePropertyChecked(
+        cookie = self.wm._conn.core.ChangeProperty(
             xproto.PropMode.Replace,
             self.wid,
             self.wm.atoms[name],
@@ -295,7 +393,9 @@ class Window:
             format,  # Format - 8, 16, 32
             len(value),
             value
-        ).check()
+        )
+        self.wm.track(cookie, self, "set_prop")
+        self.wm.flush()
 
     def list_props(self):
         reply = self.wm._conn.core.ListProperties(self.wid).reply()
@@ -304,12 +404,12 @@ class Window:
 
     def update_window_type(self):
         window_types = self.props['_NET_WM_WINDOW_TYPE']
-        if not types:
+        if not window_types:
             self.skip = True
 
         for atom in window_types:
             if atom.name in WINDOW_TYPES:
-                self.type = WINDOW_TYPES[raw_type.name]
+                self.type = WINDOW_TYPES[atom.name]
                 break
         else:
             self.type = "normal"
@@ -318,10 +418,14 @@ class Window:
 
     def update_wm_hints(self):
         # TODO: dirty code borowwed from qtile
-        l = self.get_prop(
-            Atom.WM_HINTS,
-            typ=xproto.GetPropertyType.Any,
-            unpack=int)
+        cookie = self._cookies.pop("hints", None)
+        if cookie is None:
+            l = self.get_prop(
+                Atom.WM_HINTS,
+                typ=xproto.GetPropertyType.Any,
+                unpack=int)
+        else:
+            l = self.unpack_prop(cookie.reply(), unpack=int)
         # self.log.error("WM_HINTS: {}".format(l))
         if not l:
             return
@@ -354,3 +458,18 @@ class Window:
         if len(name) > 20:
             name = name[:17] + '...'
         return "Window(%s, \"%s\")" % (self.wid, name)
+
+
+class Popup:
+    """ Override-redirect window (menu, tooltip, dropdown...).
+        We never manage them, so there are no properties, no log and no
+        event subscription, just enough to know that the window exists.
+    """
+    __slots__ = ("wid", "mapped")
+
+    def __init__(self, wid, mapped=False):
+        self.wid = wid
+        self.mapped = mapped
+
+    def __repr__(self):
+        return "Popup(%s)" % self.wid
@@ -1,13 +1,18 @@
-from defs import XCB_CONN_ERRORS, SUPPORTED_ATOMS
-from window import Window
+from defs import XCB_CONN_ERRORS, SUPPORTED_ATOMS, PROPERTYMAP, WINDOW_TYPES
+from window import Window, Popup
 from desktop import Desktop
 from keyboard import Keyboard
 from atom import AtomVault
 from mouse import Mouse
+from replies import ReplyQueue
+from coalesce import Coalescer, merge_configure_requests
+from xreader import EventReader
+from events import DECODERS
+from ratelimit import RateLimiter
 from utils import run_, get_modmask
+from timers import Timers
 from hook import Hook
 
-from xcffib.xproto import WindowError, AccessError, DrawableError
 from xcffib.xproto import CW, WindowClass, EventMask, ConfigWindow
 from xcffib import xproto
 import xcffib.randr
@@ -15,6 +20,9 @@ import xcffib.xproto
 import xcffib
 
 from useful.log import Log
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from itertools import chain
 import traceback
 import asyncio
 import signal
@@ -22,6 +30,22 @@ import sys
 import os
 
 
+# events we need to select on (root, managed windows) to serve these hooks
+HOOK_EVENT_MASKS = {
+    "window_enter": (EventMask.EnterWindow, EventMask.EnterWindow),
+    "unknown_window": (EventMask.EnterWindow, EventMask.EnterWindow),
+    "property_change": (EventMask.PropertyChange, EventMask.PropertyChange),
+}
+
+
+def sequence_before(sequence, marker):
+    """ Was the event with this sequence generated before the request
+        with the marker sequence was processed? Sequence numbers in events
+        are 16 bit and wrap around, so only the lower 16 bits are compared.
+    """
+    return 0 < (marker - sequence) & 0xffff < 0x8000
+
+
 class Xrandr:
     """ Represents screen as seen by xrandr. """
 
@@ -55,6 +79,40 @@ class WM:
         self.hook = Hook()
         self.windows = {}  # mapping between window id and Window
         self.win2desk = {}
+        # windows that are created but not mapped yet, see on_window_create
+        self._incoming = {}
+        # we place windows before they are mapped, see become_wm()
+        self.redirect = True
+        # event masks are derived from registered hooks
+        self.root_base_mask = (
+              EventMask.StructureNotify
+            | EventMask.SubstructureNotify
+            | EventMask.SubstructureRedirect
+            | EventMask.OwnerGrabButton
+        )
+        self.cache_props = True  # needs PropertyChange to stay valid
+        self.root_mask, self.window_mask = self.get_event_masks()
+        self.hook.watch(self.on_hooks_changed)
+        # requests are sent in one go at the end of a loop iteration
+        self._flush_scheduled = False
+        self._batch_depth = 0
+        # EnterNotify events caused by our own requests are ignored,
+        # see expect_crossing()
+        self._crossing_pending = False
+        self._crossing_seq = None
+        # windows with Window.configure_sequence set, see on_configure_notify
+        self._configuring = set()
+        # unchecked requests we want to match errors against
+        self._requests = OrderedDict()  # sequence -> (window, call)
+        self.max_tracked_requests = 1024
+
+        if not loop:
+            loop = asyncio.new_event_loop()
+        self._eventloop = loop
+        # shared by everything that reschedules timers all the time
+        self.timers = Timers(loop)
+        self.hook.loop = loop  # for async def handlers
+        self.hook.timers = self.timers
 
         if not display:
             display = os.environ.get("DISPLAY")
@@ -63,8 +121,11 @@ class WM:
             self._conn = xcffib.connect(display=display)
         except xcffib.ConnectionException:
             sys.exit("cannot connect to %s" % display)
+        self.replies = ReplyQueue(self._conn, self._eventloop)
+        self.reader = EventReader(self._conn)
 
         self.atoms = AtomVault(self._conn)
+        self.atoms.preload(chain(PROPERTYMAP, SUPPORTED_ATOMS, WINDOW_TYPES))
         self.desktops = desktops or [Desktop()]
         self.cur_desktop = self.desktops[0]
         self.cur_desktop.show()
@@ -79,18 +140,7 @@ class WM:
 #        for desktop in self.desktops:
 #            desktop.windows.append(self.root)
 
-        self.root.set_attr(
-            eventmask=(
-                  EventMask.StructureNotify
-                | EventMask.SubstructureNotify
-                | EventMask.FocusChange
-                # | EventMask.SubstructureRedirect
-                | EventMask.EnterWindow
-                # | EventMask.LeaveWindow
-                # | EventMask.PropertyChange
-                | EventMask.OwnerGrabButton
-            )
-        )
+        self.become_wm()
 
         # INFORM X WHICH FEATURES WE SUPPORT
         self.root.props[self.atoms._NET_SUPPORTED] = [self.atoms[a] for a in SUPPORTED_ATOMS]
@@ -111,12 +161,62 @@ class WM:
             # "CreateNotify",
             # DWM handles this to help "broken focusing windows".
             # "MapNotify",
-            "ConfigureNotify",
             "LeaveNotify",
             "FocusOut",
             "FocusIn",
             "NoExposure",
         }
+        self._build_dispatch()
+
+        # EVENTS THAT ARE SUPERSEDED BY LATER EVENTS OF THE SAME BATCH
+        self.coalesce = Coalescer()
+        self.coalesce.add(
+            "MotionNotify", key=lambda e: (e.event, e.state & 0xff),
+            barriers=["ButtonPress", "ButtonRelease"])
+        # geometry has to be applied before the window is mapped and
+        # properties read before it is set up (see on_new_window)
+        self.coalesce.add(
+            "ConfigureRequest", key=lambda e: e.window,
+            merge=merge_configure_requests, barriers=["MapRequest"])
+        self.coalesce.add(
+            "PropertyNotify", key=lambda e: (e.window, e.atom),
+            barriers=["MapRequest", "MapNotify"])
+        self.coalesce.add(
+            "EnterNotify", key=lambda e: None,
+            barriers=["ButtonPress", "ButtonRelease", "KeyPress"])
+
+        # CLIENTS FLOODING US WITH EVENTS
+        self.ratelimit = RateLimiter(coalesce=self.coalesce)
+        self._release_handle = None
+
+        # OVERRIDE-REDIRECT WINDOWS, WE DO NOT MANAGE THEM
+        self.popups = {}  # wid -> Popup
+
+        # SEE reconcile()
+        self._unmapped = set()  # unmapped root children we do not manage
+        self._reconcile_task = None
+        self.reconcile_batch = 32
+
+        # HOOKS GET DECODED EVENTS, SEE events.py
+        self.decoders = dict(DECODERS)
+
+        # EVENT QUEUES, INPUT GOES FIRST
+        self.input_events = {"KeyPress", "KeyRelease", "ButtonPress",
+                             "ButtonRelease", "MotionNotify"}
+        self._input_queue = deque()
+        self._event_queue = deque()
+        self._dispatch_scheduled = False
+        # how long (in seconds) we process events before
+        # letting other things on the loop run
+        self.xpoll_budget = 0.01
+        self.stats = {
+            "events": 0,         # events dispatched
+            "slices": 0,         # _xdispatch calls
+            "overruns": 0,       # slices that ran out of time budget
+            "max_slice": 0.0,    # longest slice in seconds
+            "budget": self.xpoll_budget,
+        }
+
         # KEYBOARD
         self.kbd = Keyboard(xcb_setup, self._conn)
         self.mouse = Mouse(conn=self._conn, root=self.root)
@@ -134,9 +234,6 @@ class WM:
         # TODO: self.update_net_desktops()
 
         # SETUP EVENT LOOP
-        if not loop:
-            loop = asyncio.new_event_loop()
-        self._eventloop = loop
         self._eventloop.add_signal_handler(signal.SIGINT, self.stop)
         self._eventloop.add_signal_handler(signal.SIGTERM, self.stop)
         self._eventloop.add_signal_handler(signal.SIGCHLD, self.on_sigchld)
@@ -153,37 +250,63 @@ class WM:
         self.hook.register("UnmapNotify", self.on_window_unmap)
         self.hook.register("KeyPress", self.on_key_press)
         # self.hook.register("KeyRelease", self.on_key_release)
-        # self.hook.register("CreateNotify", self.on_window_create)
+        self.hook.register("CreateNotify", self.on_window_create)
         self.hook.register("PropertyNotify", self.on_property_notify)
         self.hook.register("ClientMessage", self.on_client_message)
         self.hook.register("DestroyNotify", self.on_window_destroy)
         self.hook.register("EnterNotify", self.on_window_enter)
         self.hook.register("ConfigureRequest", self.on_configure_window)
+        self.hook.register("ConfigureNotify", self.on_configure_notify)
         self.hook.register("MotionNotify", self.on_mouse_event)
         self.hook.register("ButtonPress", self.on_mouse_event)
         self.hook.register("ButtonRelease", self.on_mouse_event)
 
-    def on_property_notify(self, evname, xcb_event):
-        # TODO: messy ugly code
-        wid = xcb_event.window
-        atom = self.atoms.get_name(xcb_event.atom)
-        # window = self.windows.get(wid, Window(wm=self, wid=wid, mapped=True))
-        self.log.error("PropertyNotify: %s" % atom)
-        run_("xprop -id %s %s" % (wid, atom))
+    def get_event_masks(self):
+        """ Returns (root mask, window mask) that cover registered hooks. """
+        root_mask = self.root_base_mask
+        window_mask = 0
+        if self.cache_props:
+            root_mask |= EventMask.PropertyChange
+            window_mask |= EventMask.PropertyChange
+        for event, (root, window) in HOOK_EVENT_MASKS.items():
+            if self.hook.has_hook(event):
+                root_mask |= root
+                window_mask |= window
+        return root_mask, window_mask
+
+    def on_hooks_changed(self, event):
+        """ Subscribe only for events somebody is interested in. """
+        if event not in HOOK_EVENT_MASKS:
+            return
+        root_mask, window_mask = self.get_event_masks()
+        if root_mask != self.root_mask:
+            self.root_mask = root_mask
+            self.root.set_attr(eventmask=root_mask)
+        if window_mask != self.window_mask:
+            self.window_mask = window_mask
+            for window in chain(self.windows.values(), self._incoming.values()):
+                if window is not self.root:
+                    window.set_attr(eventmask=window_mask)
+
+    def on_property_notify(self, evname, event):
+        wid = event.wid
+        if wid in self._incoming:
+            # the client is still setting up the window, refresh what
+            # we have requested in advance
+            self._incoming[wid].refresh_initial(event.atom)
+            return
+        window = event.window
+        if not window:
+            return
+        window.props.invalidate(event.atom)
+        if self.hook.has_hook("property_change"):
+            self.hook.fire("property_change", window, event.name)
 
     # TODO: dirty code, relocate to config
-    def on_client_message(self, evname, xcb_event):
-        self.log.error(dir(xcb_event))
-        data = xcb_event.data
-        resp_type = self.atoms.get_name(xcb_event.response_type)
-        type = self.atoms.get_name(xcb_event.type)
-        wid = xcb_event.window
-        self.log.error("client message: resp_type={resp_type} window={wid} type={type} data={data}"  \
-                       .format(**locals()))
-        # 'bufsize', 'data', 'format', 'pack', 'response_type', 'sequence', 'synthetic', 'type', 'window']
-
-        if type == '_NET_ACTIVE_WINDOW':
-            window = self.windows[wid]
+    def on_client_message(self, evname, event):
+        self.log.on_client_message.debug(event)
+        if event.type_name == '_NET_ACTIVE_WINDOW' and event.window:
+            window = event.window
             window.rise()
             self.focus_on(window)
 
@@ -199,23 +322,81 @@ class WM:
             except ChildProcessError:
                 break
 
-    def on_map_request(self, evname, xcb_event):
-        """ Map request is a request to draw the window on screen. """
-        wid = xcb_event.window
-        if wid not in self.windows:
-            window = self.on_new_window(wid)
-        else:
-            window = self.windows[wid]
-            self.log.on_map_request.debug("map request for %s" % window)
-        window.show()
-        if window.above_all:
-            window.rise()
-        if window.can_focus:
-            window.focus()
-
-    def on_new_window(self, wid):
-        """ Registers new window. """
-        window = Window(wm=self, wid=wid, atoms=self.atoms, mapped=True)
+    def become_wm(self):
+        """ Select events on the root window. SubstructureRedirect can be
+            held only by one client, if another WM already has it we fall
+            back to watching clients that map themselves (see on_map_notify).
+        """
+        try:
+            self._conn.core.ChangeWindowAttributesChecked(
+                self.root.wid, CW.EventMask, [self.root_mask]).check()
+        except xproto.AccessError:
+            self.log.become_wm.error(
+                "another WM is running, windows will not be redirected")
+            self.redirect = False
+            self.root_base_mask &= ~EventMask.SubstructureRedirect
+            self.root_mask, self.window_mask = self.get_event_masks()
+            self.root.set_attr(eventmask=self.root_mask)
+
+    def on_map_request(self, evname, event):
+        """ Map request is a request to draw the window on screen.
+            Desktop, placement and stacking are set up before the window
+            is mapped, all in one batch, so it appears where it should.
+        """
+        wid = event.wid
+        window = None
+        desktop = self.cur_desktop
+        with self.batch():
+            try:
+                if wid not in self.windows:
+                    # not mapped yet, it is done below
+                    window = self.on_new_window(wid, mapped=False)
+                else:
+                    window = self.windows[wid]
+                    self.log.on_map_request.debug(
+                        "map request for %s" % window)
+                if window.above_all:
+                    window.rise()
+                desktop = self.win2desk.get(window, self.cur_desktop)
+                if desktop.hidden:
+                    if window not in desktop.were_mapped:
+                        desktop.were_mapped.append(window)
+                    return
+            finally:
+                # whatever went wrong above, the client asked to be mapped
+                # and only we can do it (skip is ignored for the same reason)
+                if not desktop.hidden and not (window and window.mapped):
+                    cookie = self._conn.core.MapWindow(wid)
+                    self.track(cookie, window, "map_request")
+                    self.expect_crossing()
+                    if window:
+                        window.mapped = True
+            if window.can_focus and desktop.cur_focus is not window:
+                window.focus()
+
+    def on_window_create(self, evname, event):
+        """ Start fetching window properties long before it is mapped. """
+        wid = event.wid
+        if wid in self.windows or wid in self._incoming:
+            return
+        if event.override_redirect:
+            self.popups[wid] = Popup(wid)
+            return
+        # it also subscribes for PropertyChange, so we know if properties
+        # change before the window is mapped
+        self._incoming[wid] = Window(wm=self, wid=wid, atoms=self.atoms,
+                                     mapped=False, setup=False)
+
+    def on_new_window(self, wid, window=None, mapped=True):
+        """ Registers new window. mapped tells if it is already mapped. """
+        self._unmapped.discard(wid)
+        if window is None:
+            window = self._incoming.pop(wid, None)
+        if window is None:
+            window = Window(wm=self, wid=wid, atoms=self.atoms, mapped=mapped)
+        elif not window.ready:
+            window.mapped = mapped
+            window.setup()
         # call configuration hood first
         # to setup attributes like 'sticky'
         self.hook.fire("new_window", window)
@@ -230,37 +411,64 @@ class WM:
             self.cur_desktop.windows.append(window)
         return window
 
-    def on_map_notify(self, evname, xcb_event):
-        wid = xcb_event.window
+    def on_map_notify(self, evname, event):
+        wid = event.wid
+        self._unmapped.discard(wid)
+        if event.override_redirect and wid not in self.windows:
+            # might be set after CreateNotify, so check it once more
+            if wid in self._incoming:
+                self._incoming.pop(wid).discard()
+            self.popups.setdefault(wid, Popup(wid)).mapped = True
+            return
+        self.popups.pop(wid, None)
         if wid not in self.windows:
             window = self.on_new_window(wid)
         else:
             window = self.windows[wid]
         window.mapped = True
+        window.unmap_sequence = None  # so it cannot match after wraparound
 
-        if window.above_all:
+        # with redirect it is done before mapping, see on_map_request
+        if window.above_all and not self.redirect:
             window.rise()
         # if window.can_focus:
         #     window.focus()
 
         self.log.on_map_notify.debug("map notify for %s" % window)
 
-    def on_window_unmap(self, evname, xcb_event):
-        wid = xcb_event.window
+    def on_window_unmap(self, evname, event):
+        wid = event.wid
+        if wid in self.popups:
+            self.popups[wid].mapped = False
+            return
         if wid not in self.windows:
             return
         window = self.windows[wid]
         window.mapped = False
+        if event.sequence == window.unmap_sequence:
+            # we did it ourselves (e.g., switching desktops)
+            window.unmap_sequence = None
+            return
         self.hook.fire("window_unmap", window)
 
-    def on_window_destroy(self, evname, xcb_event):
-        wid = xcb_event.window
+    def on_window_destroy(self, evname, event):
+        self.forget_window(event.wid)
+
+    def forget_window(self, wid):
+        """ Drop everything we know about the window. """
+        self.popups.pop(wid, None)
+        self._unmapped.discard(wid)
+        if wid in self._incoming:
+            self._incoming.pop(wid).discard()
+        self.ratelimit.forget(wid)
+        self._configuring.discard(self.windows.get(wid))
         if wid not in self.windows:
             return
 
         window = self.windows[wid]
         assert isinstance(window, Window), "it's not a window: %s (%s)" % (
             window, type(window))
+        window.discard()  # replies nobody is going to read
 
         for desktop in self.desktops:
             try:
@@ -272,13 +480,17 @@ class WM:
         if window in self.win2desk:
             del self.win2desk[window]
 
-    def on_window_enter(self, evname, xcb_event):
-        wid = xcb_event.event
-        if wid not in self.windows:
+    def on_window_enter(self, evname, event):
+        if event.mode != xproto.NotifyMode.Normal:
+            return  # caused by grabs, the pointer did not move
+        if self.caused_by_us(event):
+            self.log.on_window_enter.debug("ignoring crossing caused by WM")
+            return
+        window = event.window
+        if not window:
             # self.log.on_window_enter.error("no window with wid=%s" % wid)
-            self.hook.fire("unknown_window", wid)
+            self.hook.fire("unknown_window", event.wid)
             return
-        window = self.windows[wid]
         # self.log.on_window_enter("window_enter: %s %s" % (wid, window))
         self.hook.fire("window_enter", window)
 
@@ -311,21 +523,14 @@ class WM:
             pointer_mode,
             keyboard_mode
         )
-        self.flush()  # TODO: do we need this?
+        self.flush()
         return event
 
-    def on_key_press(self, evname, xcb_event):
-        # TODO: ignore capslock, scrolllock and other modifiers?
-        modmap = xcb_event.state
-        keycode = xcb_event.detail
-        event = ("on_key_press", modmap, keycode)
-        self.hook.fire(event)
+    def on_key_press(self, evname, event):
+        self.hook.fire(event.key)
 
-    def on_key_release(self, evname, xcb_event):
-        modmap = xcb_event.state
-        keycode = xcb_event.detail
-        event = ("on_key_release", modmap, keycode)
-        self.hook.fire(event)
+    def on_key_release(self, evname, event):
+        self.hook.fire(event.key)
 
     def grab_mouse(self, modifiers, button, owner_events=False, window=None):
         # http://www.x.org/archive/X11R7.7/doc/man/man3/xcb_grab_button.3.xhtml
@@ -351,7 +556,7 @@ class WM:
             button,
             modmask,
         )
-        self.flush()  # TODO: do we need this?
+        self.flush()
         return event
 
     def hotkey(self, keys, cmd):
@@ -374,11 +579,12 @@ class WM:
             return
         self.log.debug("switching from {} to {}".format(
             self.cur_desktop, desktop))
-        self.cur_desktop.hide()
-        self.cur_desktop = desktop
-        self.cur_desktop.show()
-        # TODO: move this code to Desktop.show()
-        self.root.props[self.atom._NET_CURRENT_DESKTOP] = desktop.id
+        with self.batch():
+            self.cur_desktop.hide()
+            self.cur_desktop = desktop
+            self.cur_desktop.show()
+            # TODO: move this code to Desktop.show()
+            self.root.props[self.atoms._NET_CURRENT_DESKTOP] = desktop.id
 
     def relocate_to(self, window: Window, to_desktop: Desktop):
         """ Relocates window to a specific desktop. """
@@ -394,23 +600,13 @@ class WM:
                 "no need to relocate %s because remains on the same desktop" % window)
             return
 
-        from_desktop.remove(window)
-        to_desktop.add(window)
+        with self.batch():
+            from_desktop.remove(window)
+            to_desktop.add(window)
 
-    def on_mouse_event(self, evname, xcb_event):
+    def on_mouse_event(self, evname, event):
         """evname is one of ButtonPress, ButtonRelease or MotionNotify."""
-        # l = [(attr, getattr(xcb_event, attr)) for attr in sorted(dir(xcb_event)) if not attr.startswith('_')]
-        # print(evname)
-        # print(l)
-        modmask = xcb_event.state & 0xff  # TODO: is the mask correct?
-        if evname == 'MotionNotify':
-            button = 1  # TODO
-        else:
-            button = xcb_event.detail
-
-        event = ('on_mouse', modmask, button)
-        # print(event)
-        self.hook.fire(event, evname, xcb_event)
+        self.hook.fire(event.key, evname, event)
 
     def on_configure_window(self, _, event):
         # This code is so trivial that I just took it from fpwm as is :)
@@ -429,7 +625,20 @@ class WM:
             values.append(event.sibling)
         if event.value_mask & ConfigWindow.StackMode:
             values.append(event.stack_mode)
-        self._conn.core.ConfigureWindow(event.window, event.value_mask, values)
+        cookie = self._conn.core.ConfigureWindow(
+            event.wid, event.value_mask, values)
+        self.track(cookie, event.window, "configure_request")
+        self.flush()
+
+    def on_configure_notify(self, _, event):
+        """ Keep geometry cache up to date. """
+        window = event.window or self._incoming.get(event.wid)
+        if not window:
+            return
+        if window.configure_sequence is not None and \
+                sequence_before(event.sequence, window.configure_sequence):
+            return  # set_geometry() has already put a newer value
+        window.update_geometry(event.x, event.y, event.width, event.height)
 
     def create_window(self, x, y, width, height):
         """ Create a window. Right now only used for initialization, see __init__. """
@@ -453,15 +662,26 @@ class WM:
         """ Gets all windows in the system. """
         self.log.debug("performing scan of all mapped windows")
         q = self._conn.core.QueryTree(self.root.wid).reply()
-        for wid in q.children:
-            # attrs=self._conn.core.GetWindowAttributes(wid).reply()
-            # print(attrs, type(attrs))
-            # if attrs.map_state == xproto.MapState.Unmapped:
-            #    self.log.scan.debug(
-            #        "window %s is not mapped, skipping" % wid)  # TODO
-            #    continue
-            if wid not in self.windows:
-                self.on_new_window(wid)
+        # send all requests first and only then collect replies,
+        # otherwise we pay a round trip for every request
+        wids = [wid for wid in q.children if wid not in self.windows]
+        cookies = [self._conn.core.GetWindowAttributes(wid) for wid in wids]
+        pending = []
+        for wid, cookie in zip(wids, cookies):
+            try:
+                attrs = cookie.reply()
+            except xcffib.Error:
+                continue  # window is already gone
+            if not self.should_manage(wid, attrs):
+                self.log.scan.debug(
+                    "window %s is not mapped or a popup, skipping" % wid)
+                continue
+            pending.append(Window(self, wid=wid, atoms=self.atoms, setup=False))
+        for window in pending:
+            try:
+                self.on_new_window(window.wid, window=window)
+            except xcffib.Error:
+                window.discard()
         self.log.scan.info("the following windows are active: %s" %
                            sorted(self.windows.values()))
 
@@ -472,14 +692,171 @@ class WM:
                 # on empty desktop there is nothing to focus on
                 self.cur_desktop.focus_on(windows[-1], warp=True)
 
+    def should_manage(self, wid, attrs):
+        """ Decide by window attributes if we should manage the window.
+            Override-redirect windows are remembered as popups.
+        """
+        mapped = attrs.map_state != xproto.MapState.Unmapped
+        if attrs.override_redirect:
+            self.popups[wid] = Popup(wid, mapped=mapped)
+            return False
+        if not mapped:
+            # MapRequest/MapNotify will tell us if that changes
+            self._unmapped.add(wid)
+        return mapped
+
+    def reconcile(self):
+        """ Bring the window table in sync with the server: adopt mapped
+            windows we do not know about and drop the ones that are gone.
+            Runs in the background as soon as the loop is idle, calls made
+            while it is running are merged. Returns the task.
+        """
+        task = self._reconcile_task
+        if task is None or task.done():
+            task = self._eventloop.create_task(self._reconcile())
+            task.add_done_callback(self._reconcile_done)
+            self._reconcile_task = task
+        return task
+
+    async def _reconcile(self):
+        # windows adopted while we wait for the reply are not in it
+        known = [wid for wid in chain(self.windows, self.popups,
+                                      self._unmapped)
+                 if wid != self.root.wid]
+        tree = await self.reply(self._conn.core.QueryTree(self.root.wid))
+        children = set(tree.children)
+        # absence in the list is only a hint, the window is gone only
+        # if the server says so
+        suspects = [wid for wid in known if wid not in children]
+        replies = await asyncio.gather(
+            *(self.reply(self._conn.core.GetWindowAttributes(wid))
+              for wid in suspects),
+            return_exceptions=True)
+        for wid, attrs in zip(suspects, replies):
+            if isinstance(attrs, xproto.WindowError):
+                self.log.reconcile.debug("dropping stale window %s" % wid)
+                self.forget_window(wid)
+        missing = [wid for wid in tree.children
+                   if wid not in self.windows and wid not in self._incoming
+                   and wid not in self.popups and wid not in self._unmapped]
+        batch = self.reconcile_batch
+        for i in range(0, len(missing), batch):
+            chunk = missing[i:i + batch]
+            # one round trip per chunk
+            replies = await asyncio.gather(
+                *(self.reply(self._conn.core.GetWindowAttributes(wid))
+                  for wid in chunk),
+                return_exceptions=True)
+            # events might have adopted some of them in the meantime
+            pending = [
+                Window(self, wid=wid, atoms=self.atoms, setup=False)
+                for wid, attrs in zip(chunk, replies)
+                if not isinstance(attrs, BaseException)
+                and wid not in self.windows and wid not in self._incoming
+                and self.should_manage(wid, attrs)]
+            for window in pending:
+                self.log.reconcile.debug("adopting window %s" % window.wid)
+                try:
+                    self.on_new_window(window.wid, window=window)
+                except xcffib.Error:
+                    window.discard()  # window is already gone
+
+    def _reconcile_done(self, task):
+        if not task.cancelled() and task.exception():
+            self.log.reconcile.error(
+                "reconciliation failed: %r" % task.exception())
+
     def finalize(self):
         """ This code is run when event loop is terminated. """
         pass  # currently nothing to do here
 
     def flush(self):
-        """ Force pending X request to be sent.
-            By default XCB aggressevly buffers for performance reasons. """
-        return self._conn.flush()
+        """ Schedule pending X requests to be sent.
+            By default XCB aggressevly buffers for performance reasons.
+            Requests issued during one loop iteration are written to
+            the socket with a single flush at the end of the iteration.
+        """
+        if self._flush_scheduled or self._batch_depth:
+            return
+        self._flush_scheduled = True
+        self._eventloop.call_soon(self.flush_now)
+
+    def flush_now(self):
+        """ Send pending X requests right away. """
+        self._flush_scheduled = False
+        if self._crossing_pending:
+            # Events carry the sequence number of the last request processed
+            # by the server, so crossing events caused by the requests
+            # we are about to send will have sequence below this marker.
+            self._crossing_pending = False
+            cookie = self._conn.core.NoOperation()
+            self._crossing_seq = cookie.sequence & 0xffff
+        result = self._conn.flush()
+        if self.replies:
+            # replies might have been read by a blocking call in between
+            self.replies.poll()
+        return result
+
+    def expect_crossing(self):
+        """ Requests sent in this loop iteration may move windows under
+            the pointer. EnterNotify events they cause will be ignored.
+        """
+        self._crossing_pending = True
+        self.flush()
+
+    def caused_by_us(self, event):
+        """ Was the event generated before the last expect_crossing()
+            requests were processed by the server?
+        """
+        if self._crossing_seq is None:
+            return False
+        return sequence_before(event.sequence, self._crossing_seq)
+
+    def reply(self, cookie):
+        """ Asynchronous version of cookie.reply(). Returns a future,
+            so many requests can be sent first and awaited together:
+
+                geom, attrs = await asyncio.gather(
+                    wm.reply(conn.core.GetGeometry(wid)),
+                    wm.reply(conn.core.GetWindowAttributes(wid)))
+        """
+        future = self.replies.submit(cookie)
+        self.flush()
+        return future
+
+    @contextmanager
+    def batch(self):
+        """ Group X requests and send them at once when the block is over.
+            Blocks can be nested, the flush happens on the outermost one.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.flush_now()
+
+    def track(self, cookie, window, call):
+        """ Remember who sent an unchecked request, so that a possible
+            error can be reported asynchronously (see on_x_error).
+        """
+        # X errors carry only the lower 16 bits of the sequence number
+        seq = cookie.sequence & 0xffff
+        requests = self._requests
+        requests.pop(seq, None)
+        requests[seq] = (window, call)
+        if len(requests) > self.max_tracked_requests:
+            requests.popitem(last=False)
+        return cookie
+
+    def on_x_error(self, error):
+        """ Called for every error coming from X server. """
+        window, call = self._requests.pop(error.sequence, (None, None))
+        self.log.on_x_error.debug("{} in {} (sequence {}) for {}".format(
+            error.__class__.__name__, call, error.sequence, window))
+        if self.hook.has_hook("x_error"):
+            self.hook.fire("x_error", error, window, call)
 
     def xsync(self):
         """ Flush XCB queue and wait till it is processed by X server. """
@@ -499,6 +876,9 @@ class WM:
                 self.xsync()
         except Exception as err:
             self.log.stop.error("error on stop: %s" % err)
+        self.replies.cancel()
+        self.hook.cancel_tasks()
+        self.timers.clear()
         self.log.stop.debug("stopping event loop")
         self._eventloop.stop()
 
@@ -516,38 +896,189 @@ class WM:
         finally:
             self.finalize()
 
-    def _xpoll(self):
-        """ Fetch incomming events (if any) and call hooks. """
-
-        # OK, kids, today I'll teach you how to write reliable enterprise
-        # software! You just catch all the exceptions in the top-level loop
-        # and ignore them. No, I'm kidding, these exceptions are no use
-        # for us because we don't care if a window cannot be drawn or something.
-        # We actually only need to handle just a few events and ignore the rest.
-        # Exceptions happen because of the async nature of X.
-
+    def _build_dispatch(self):
+        """ Precompute event class -> hook name table.
+            Ignored events are mapped to None, so they can be dropped
+            without any string work in the event loop.
+        """
+        self._dispatch = {}
+        for name, cls in vars(xproto).items():
+            if not name.endswith("Event") or not isinstance(cls, type):
+                continue
+            if not issubclass(cls, xcffib.Event):
+                continue
+            evname = name[:-5]
+            self._dispatch[cls] = None if evname in self.ignoreEvents else evname
+        # ignored core events are dropped before they are unpacked
+        self.reader.ignored = frozenset(
+            code for code, cls in xcffib.core_events.items()
+            if cls in self._dispatch and self._dispatch[cls] is None)
+
+    def ignore_event(self, evname):
+        """ Stop dispatching events of the given type (e.g., "MotionNotify"). """
+        self.ignoreEvents.add(evname)
+        self._build_dispatch()
+
+    def _event_name(self, cls):
+        """ Slow path for event classes not known in advance (extensions). """
+        evname = cls.__name__
+        if evname.endswith("Event"):
+            evname = evname[:-5]
+        if evname in self.ignoreEvents:
+            evname = None
+        self._dispatch[cls] = evname
+        return evname
+
+    def _xread(self, queued=False):
+        """ Drain X event queue. Returns a list of (evname, event)
+            or None if the connection is broken. With queued=True only
+            events already read by xcb are returned.
+        """
+        dispatch = self._dispatch
+        reader = self.reader
+        events = []
         while True:
             try:
-                xcb_event = self._conn.poll_for_event()
+                xcb_event = reader.poll(queued)
                 if not xcb_event:
                     break
-                evname = xcb_event.__class__.__name__
-                if evname.endswith("Event"):
-                    evname = evname[:-5]
-                if evname in self.ignoreEvents:
-                    self.log._xpoll.info("ignoring %s" % xcb_event)
+                cls = xcb_event.__class__
+                try:
+                    evname = dispatch[cls]
+                except KeyError:
+                    evname = self._event_name(cls)
+                if evname is None:
                     continue
-                self.log._xpoll.critical("got %s %s" % (evname, xcb_event))
-                self.hook.fire(evname, xcb_event)
-                self.flush()  # xcb doesn't flush implicitly
-            except (WindowError, AccessError, DrawableError):
-                self.log.debug("(minor exception)")
+                events.append((evname, xcb_event))
+            except xcffib.Error as error:
+                # errors from unchecked requests, mostly windows that are
+                # already gone
+                self.on_x_error(error)
             except Exception as e:
-                self.log._xpoll.error(traceback.format_exc())
+                self.log._xread.error(traceback.format_exc())
                 error_code = self._conn.has_error()
                 if error_code:
                     error_string = XCB_CONN_ERRORS[error_code]
                     self.log.critical("Shutting down due to X connection error %s (%s)" %
                                       (error_string, error_code))
                     self.stop(xserver_dead=True)
-                    break
+                    return None
+        return events
+
+    def _xpoll(self):
+        """ Fetch incomming events (if any) and call hooks. """
+
+        # OK, kids, today I'll teach you how to write reliable enterprise
+        # software! You just catch all the exceptions in the top-level loop
+        # and ignore them. No, I'm kidding, these exceptions are no use
+        # for us because we don't care if a window cannot be drawn or something.
+        # We actually only need to handle just a few events and ignore the rest.
+        # Exceptions happen because of the async nature of X.
+
+        self.reader.wakeup()
+        self._enqueue(self._xread())
+        # a pending slice picks up new events itself, dispatching here as
+        # well would give storms more than one budget per iteration
+        if not self._dispatch_scheduled:
+            self._xdispatch()
+
+    def _enqueue(self, events):
+        """ Put events into dispatch queues, returns False if there are none. """
+        if not events:
+            return False
+        if len(events) > 1:
+            events = self.coalesce(events)
+        self._queue(self._ratelimit(events))
+        return True
+
+    def _queue(self, events):
+        input_events = self.input_events
+        for item in events:
+            if item[0] in input_events:
+                self._input_queue.append(item)
+            else:
+                self._event_queue.append(item)
+
+    def _ratelimit(self, events):
+        """ Park events from clients that send too many of them. """
+        events, storms = self.ratelimit.filter(events, self._eventloop.time())
+        for wid, evname in storms:
+            window = self.windows.get(wid, wid)
+            self.log.ratelimit.notice(
+                "%s is flooding us with %s, throttling" % (window, evname))
+            self.hook.fire("client_storm", window, evname)
+        if self.ratelimit.parked and not self._release_handle:
+            self._release_handle = self._eventloop.call_later(
+                self.ratelimit.next_release(), self._release_throttled)
+        return events
+
+    def _release_throttled(self):
+        self._release_handle = None
+        events = self.ratelimit.release(self._eventloop.time())
+        if self.ratelimit.parked:
+            self._release_handle = self._eventloop.call_later(
+                self.ratelimit.next_release(), self._release_throttled)
+        if events:
+            self._queue(events)
+            if not self._dispatch_scheduled:
+                self._xdispatch()
+
+    def _clear_configuring(self, sequence):
+        """ Same as for _crossing_seq, but for set_geometry() markers. """
+        for window in list(self._configuring):
+            if not sequence_before(sequence, window.configure_sequence):
+                window.configure_sequence = None
+                self._configuring.discard(window)
+
+    def _xdispatch(self):
+        """ Call hooks for queued events, but not longer than xpoll_budget.
+            The rest is processed on the next loop iteration, so timers
+            and other callbacks are not starved by event storms.
+        """
+        self._dispatch_scheduled = False
+        input_queue = self._input_queue
+        event_queue = self._event_queue
+        fire = self.hook.fire
+        decoders = self.decoders
+        time = self._eventloop.time
+        start = time()
+        deadline = start + self.xpoll_budget
+        count = 0
+        while input_queue or event_queue:
+            evname, xcb_event = (input_queue or event_queue).popleft()
+            count += 1
+            try:
+                # forget the marker as soon as the server is past it, or it
+                # would match again once the 16 bit sequence wraps around
+                if self._crossing_seq is not None and not sequence_before(
+                        xcb_event.sequence, self._crossing_seq):
+                    self._crossing_seq = None
+                if self._configuring:
+                    self._clear_configuring(xcb_event.sequence)
+                decode = decoders.get(evname)
+                if decode:
+                    xcb_event = decode(xcb_event, self)
+                fire(evname, xcb_event)
+            except xcffib.Error as error:
+                self.on_x_error(error)
+            except Exception:
+                self.log._xdispatch.error(traceback.format_exc())
+            if time() >= deadline and (input_queue or event_queue):
+                self.stats["overruns"] += 1
+                self._dispatch_scheduled = True
+                self._eventloop.call_soon(self._xdispatch)
+                break
+        stats = self.stats
+        stats["events"] += count
+        stats["slices"] += 1
+        stats["budget"] = self.xpoll_budget
+        stats["max_slice"] = max(stats["max_slice"], time() - start)
+        # handlers waiting for replies make xcb read events from the socket,
+        # they won't wake us up, so pick them here
+        if not self._dispatch_scheduled and self._enqueue(self._xread(queued=True)):
+            self._dispatch_scheduled = True
+            self._eventloop.call_soon(self._xdispatch)
+        if self.replies:
+            self.replies.poll()
+        # xcb doesn't flush implicitly
+        self.flush()
@@ -0,0 +1,92 @@
+"""
+Reading events from the X connection.
+"""
+
+from xcffib import ffi, lib
+import xcffib
+
+# xcffib renamed this at some point
+c_free = getattr(xcffib, "c_free", None) or lib.free
+
+
+def _get_poll_for_queued_event():
+    # not every xcffib declares it
+    try:
+        return lib.xcb_poll_for_queued_event
+    except AttributeError:
+        pass
+    try:
+        ffi.cdef("xcb_generic_event_t *xcb_poll_for_queued_event(xcb_connection_t *c);")
+        return lib.xcb_poll_for_queued_event
+    except Exception:
+        return None
+
+
+poll_for_queued_event = _get_poll_for_queued_event()
+
+
+class EventReader:
+    """ Replacement for conn.poll_for_event() that tries to do as few
+        syscalls as possible and drops uninteresting events by looking at
+        the response type in xcb's own buffer, without building xcffib
+        objects for them.
+
+        Only the first poll after wakeup() may read from the socket
+        (xcb reads everything that is available in one go), the following
+        ones just take events already queued by xcb. Whatever arrives later
+        makes the fd readable and wakes us up again.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._fresh = True
+        self.ignored = frozenset()  # response types to drop
+        self.stats = {
+            "wakeups": 0,  # wakeup() calls
+            "reads": 0,    # polls that may read from the socket
+            "events": 0,   # events returned
+            "dropped": 0,  # events dropped without unpacking
+        }
+
+    @property
+    def dropped(self):
+        return self.stats["dropped"]
+
+    def syscalls_per_event(self):
+        """ Upper bound of read syscalls per received event. """
+        stats = self.stats
+        events = stats["events"] + stats["dropped"]
+        return stats["reads"] / events if events else 0.0
+
+    def wakeup(self):
+        """ Call it when the connection fd becomes readable. """
+        self._fresh = True
+        self.stats["wakeups"] += 1
+
+    def poll(self, queued=False):
+        """ Returns next interesting event or None if there is nothing
+            to read. Errors are raised as exceptions, like xcffib does.
+            With queued=True the socket is not touched at all.
+        """
+        conn = self._conn
+        ignored = self.ignored
+        stats = self.stats
+        while True:
+            if queued and poll_for_queued_event is None:
+                return None  # cannot peek without touching the socket
+            if self._fresh and not queued or poll_for_queued_event is None:
+                self._fresh = False
+                stats["reads"] += 1
+                e = lib.xcb_poll_for_event(conn._conn)
+            else:
+                e = poll_for_queued_event(conn._conn)
+            if e == ffi.NULL:
+                conn.invalid()  # raises if connection is broken
+                return None
+            # high bit is set for events sent with SendEvent
+            if e.response_type & 0x7f in ignored:
+                c_free(e)
+                stats["dropped"] += 1
+                continue
+            stats["events"] += 1
+            return conn.hoist_event(ffi.gc(e, c_free))